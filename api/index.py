@@ -10,13 +10,28 @@ import os
 import csv
 import io
 import re
-import urllib.request
-import urllib.error
+import hashlib
+import heapq
+import itertools
+import http.client
+import threading
+import urllib.parse
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
+from operator import itemgetter
 from http.server import BaseHTTPRequestHandler
 from datetime import datetime
 
 GROQ_API_KEY = os.environ.get('GROQ_API_KEY', '')
 GROQ_MODEL = 'llama-3.3-70b-versatile'
+GROQ_HOST = 'api.groq.com'
+GROQ_PATH = '/openai/v1/chat/completions'
+
+# In-process LRU of AI responses keyed by prompt hash (survives warm invocations)
+AI_CACHE_SIZE = 256
+_ai_cache = OrderedDict()
+_ai_cache_lock = threading.Lock()
+_AI_ERROR_PREFIX = 'AI analysis unavailable'
 
 
 # ─── POS Format Detection & Normalization ────────────────────────────────────
@@ -135,59 +150,114 @@ POS_COLUMN_MAPS = {
 }
 
 
+# Distinctive column signatures per POS export (normalized header names)
+_SIG_SUMMARY_NAME = frozenset({'name', 'item_name'})
+_SIG_SQUARE = frozenset({'gross_sales', 'net_sales'})
+_SIG_TOAST_ITEM = frozenset({'menu_item', 'menu_group'})
+_SIG_TOAST_AMOUNT = frozenset({'gross_amount', 'net_amount', 'business_date'})
+_SIG_SHOPIFY = frozenset({'lineitem_name', 'lineitem_quantity', 'lineitem_price'})
+_SIG_CLOVER = frozenset({'created_time', 'unit_qty', 'labels'})
+_SIG_LIGHTSPEED = frozenset({'cost_of_goods', 'quantity_sold', 'product_category'})
+_SIG_LIGHTSPEED_PRODUCT = frozenset({'revenue', 'total_revenue', 'gross_profit'})
+
+
 def detect_pos_format(headers):
     """Auto-detect which POS system exported this CSV based on column names."""
-    h_lower = {h.strip().lower().replace(' ', '_') for h in headers}
+    return _detect_pos_format(frozenset(headers))
+
+
+@lru_cache(maxsize=64)
+def _detect_pos_format(headers):
+    h_lower = frozenset(_norm_header(h) for h in headers)
 
     # Square Summary Report: has 'section' + ('name' or 'item_name') + amount column (Amount_AUD etc)
-    if 'section' in h_lower and ('name' in h_lower or 'item_name' in h_lower):
-        amount_cols = {c for c in h_lower if c.startswith('amount')}
-        if amount_cols:
+    if 'section' in h_lower and not h_lower.isdisjoint(_SIG_SUMMARY_NAME):
+        if any(c.startswith('amount') for c in h_lower):
             return 'square_summary'
 
     # Square: has 'gross_sales' + 'net_sales' columns (very distinctive)
-    if h_lower & {'gross_sales', 'net_sales'}:
+    if not h_lower.isdisjoint(_SIG_SQUARE):
         return 'square'
 
     # Toast: has 'menu_item' or 'menu_group' + ('gross_amount' or 'net_amount')
-    if ('menu_item' in h_lower or 'menu_group' in h_lower) and h_lower & {'gross_amount', 'net_amount', 'business_date'}:
+    if not h_lower.isdisjoint(_SIG_TOAST_ITEM) and not h_lower.isdisjoint(_SIG_TOAST_AMOUNT):
         return 'toast'
 
     # Shopify: has 'lineitem_name' or 'lineitem_quantity' (very distinctive)
-    if h_lower & {'lineitem_name', 'lineitem_quantity', 'lineitem_price'}:
+    if not h_lower.isdisjoint(_SIG_SHOPIFY):
         return 'shopify'
 
     # Clover: has 'created_time' or 'unit_qty' or 'labels'
-    if h_lower & {'created_time', 'unit_qty', 'labels'}:
+    if not h_lower.isdisjoint(_SIG_CLOVER):
         return 'clover'
 
     # Lightspeed: has 'product' or 'product_name' + 'cost_of_goods' or 'quantity_sold'
-    if h_lower & {'cost_of_goods', 'quantity_sold', 'product_category'}:
+    if not h_lower.isdisjoint(_SIG_LIGHTSPEED):
         return 'lightspeed'
-    if 'product' in h_lower and h_lower & {'revenue', 'total_revenue', 'gross_profit'}:
+    if 'product' in h_lower and not h_lower.isdisjoint(_SIG_LIGHTSPEED_PRODUCT):
         return 'lightspeed'
 
     return 'generic'
 
 
-def normalize_row(row, pos_format):
+# Fields read as text; everything else in POS_COLUMN_MAPS is numeric
+_STR_FIELDS = ('item', 'category', 'date', 'time', 'transaction_id', 'sku', 'modifiers',
+               'variation', 'supplier', 'order_id', 'server')
+
+
+def resolve_columns(headers, pos_format):
+    """
+    Resolve each internal field of a POS format to the matching column
+    positions in this file, once per file instead of once per row.
+    Returns { field: (index, ...) } in lookup priority order; fields normalize_row
+    reads are always present (empty when the format has no such column). The
+    result is cached per header layout and shared, so treat it as read-only.
+    """
+    return _resolve_columns(tuple(headers), pos_format)
+
+
+# Fields normalize_row reads, unpacked from the resolved columns in one C call
+_ROW_COLUMNS = ('item', 'category', 'quantity', 'date', 'variation', 'gross_revenue',
+                'net_revenue', 'discount', 'price_per_unit', 'cost', 'gross_profit')
+_row_columns = itemgetter(*_ROW_COLUMNS)
+
+
+@lru_cache(maxsize=64)
+def _resolve_columns(headers, pos_format):
+    col_map = POS_COLUMN_MAPS.get(pos_format, POS_COLUMN_MAPS['generic'])
+    hmap = _header_map(headers)
+    columns = dict.fromkeys(_ROW_COLUMNS, ())
+    for field, options in col_map.items():
+        columns[field] = tuple(_resolve_keys(hmap, options, currency=field not in _STR_FIELDS))
+    return columns
+
+
+def normalize_row(row, pos_format, columns=None):
     """
     Normalize a POS row into our standard internal format:
     { item, category, quantity, revenue (total, not per-unit), cost (total), date }
 
     Key insight: Square/Lightspeed/Toast export TOTAL revenue per line
     (already multiplied by qty), while generic CSVs may have per-unit price.
+
+    row: list of cell values aligned with the headers passed to resolve_columns()
+    (as returned by parse_csv_text), or a single dict when columns is omitted.
+    columns: result of resolve_columns() for those headers.
     """
-    col_map = POS_COLUMN_MAPS.get(pos_format, POS_COLUMN_MAPS['generic'])
+    if columns is None:
+        columns = resolve_columns(row, pos_format)
+        row = list(row.values())
+    (item_c, cat_c, qty_c, date_c, var_c, gross_c,
+     net_c, disc_c, unit_c, cost_c, gp_c) = _row_columns(columns)
 
-    item = _flex_str(row, col_map.get('item', []))
-    category = _flex_str(row, col_map.get('category', []))
-    qty = _flex_num(row, col_map.get('quantity', [])) or 1
-    date = _flex_str(row, col_map.get('date', []))
+    item = _flex_str(row, item_c)
+    category = _flex_str(row, cat_c)
+    qty = _flex_num(row, qty_c) or 1
+    date = _flex_str(row, date_c)
 
     # Square Summary: append variation to item name, category isn't in the data per-row
     if pos_format == 'square_summary':
-        variation = _flex_str(row, col_map.get('variation', []))
+        variation = _flex_str(row, var_c)
         if variation:
             item = f"{item} ({variation})"
         # The 'Type' column is just "Item" for all item rows — not useful as category
@@ -195,10 +265,10 @@ def normalize_row(row, pos_format):
         category = ''
 
     # --- Revenue calculation (handle POS-specific logic) ---
-    gross_rev = _flex_num(row, col_map.get('gross_revenue', []))
-    net_rev = _flex_num(row, col_map.get('net_revenue', []))
-    discount = abs(_flex_num(row, col_map.get('discount', [])))
-    per_unit_price = _flex_num(row, col_map.get('price_per_unit', []))
+    gross_rev = _flex_num(row, gross_c)
+    net_rev = _flex_num(row, net_c)
+    discount = abs(_flex_num(row, disc_c))
+    per_unit_price = _flex_num(row, unit_c)
 
     if pos_format == 'square':
         # Square: Net Sales = Gross Sales - Discounts (already totals, use Net Sales)
@@ -222,8 +292,8 @@ def normalize_row(row, pos_format):
             revenue = 0
 
     # --- Cost calculation ---
-    cost_total = _flex_num(row, col_map.get('cost', []))
-    gross_profit_val = _flex_num(row, col_map.get('gross_profit', []))
+    cost_total = _flex_num(row, cost_c)
+    gross_profit_val = _flex_num(row, gp_c)
 
     if pos_format in ('square', 'square_summary', 'toast', 'clover', 'shopify', 'lightspeed'):
         # POS costs are typically total cost for the line
@@ -248,8 +318,10 @@ def normalize_row(row, pos_format):
         cost = 0
         qty = 0
 
-    # Normalize date format
-    date = _normalize_date(date)
+    # Normalize date format. Every recognised layout is decided by the first
+    # 10 characters, so keying the cache on that prefix lets timestamped
+    # exports ("1/15/2026 2:30 PM") hit it once per day instead of per row.
+    date = _normalize_date(date[:10])
 
     return {
         'item': item,
@@ -261,35 +333,33 @@ def normalize_row(row, pos_format):
     }
 
 
+_US_DATE = re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})')
+_DASHED_DATE = re.compile(r'(\d{1,2})-(\d{1,2})-(\d{4})')
+
+
+@lru_cache(maxsize=4096)
 def _normalize_date(date_str):
-    """Try to normalize various date formats to YYYY-MM-DD."""
+    """Try to normalize various date formats to YYYY-MM-DD.
+    Memoized: an export repeats each raw date string across many rows."""
     if not date_str:
         return ''
 
-    # Already in YYYY-MM-DD
-    if re.match(r'^\d{4}-\d{2}-\d{2}', date_str):
+    # Already YYYY-MM-DD, incl. ISO datetime "2026-01-15T14:30:00" and
+    # Shopify-style "2026-01-15 14:30:00 +0000" — checked without the regex engine
+    if (len(date_str) >= 10 and date_str[4] == '-' and date_str[7] == '-'
+            and date_str[:4].isdecimal() and date_str[5:7].isdecimal() and date_str[8:10].isdecimal()):
         return date_str[:10]
 
     # MM/DD/YYYY or M/D/YYYY (US format — Square, Toast)
-    m = re.match(r'^(\d{1,2})/(\d{1,2})/(\d{4})', date_str)
+    m = _US_DATE.match(date_str)
     if m:
         return f"{m.group(3)}-{m.group(1).zfill(2)}-{m.group(2).zfill(2)}"
 
-    # DD/MM/YYYY (international)
-    m = re.match(r'^(\d{1,2})-(\d{1,2})-(\d{4})', date_str)
+    # DD-MM-YYYY (international)
+    m = _DASHED_DATE.match(date_str)
     if m:
         return f"{m.group(3)}-{m.group(2).zfill(2)}-{m.group(1).zfill(2)}"
 
-    # ISO datetime: 2026-01-15T14:30:00
-    m = re.match(r'^(\d{4}-\d{2}-\d{2})T', date_str)
-    if m:
-        return m.group(1)
-
-    # Shopify-style: "2026-01-15 14:30:00 +0000"
-    m = re.match(r'^(\d{4}-\d{2}-\d{2})\s', date_str)
-    if m:
-        return m.group(1)
-
     return date_str.strip()[:10]
 
 
@@ -320,12 +390,18 @@ def parse_expense_data(expense_csv_text):
     if not rows:
         return {}, {}, 0, []
 
+    hmap = _header_map(headers)
+    item_keys = _resolve_keys(hmap, _EXPENSE_ITEM_COLS)
+    cost_keys = _resolve_keys(hmap, _EXPENSE_COST_COLS, currency=True)
+    qty_keys = _resolve_keys(hmap, _EXPENSE_QTY_COLS, currency=True)
+    cat_keys = _resolve_keys(hmap, _EXPENSE_CAT_COLS)
+
     expense_rows = []
     for row in rows:
-        name = _flex_str(row, _EXPENSE_ITEM_COLS)
-        cost = _flex_num(row, _EXPENSE_COST_COLS)
-        qty = _flex_num(row, _EXPENSE_QTY_COLS) or 1
-        cat = _flex_str(row, _EXPENSE_CAT_COLS)
+        name = _flex_str(row, item_keys)
+        cost = _flex_num(row, cost_keys)
+        qty = _flex_num(row, qty_keys) or 1
+        cat = _flex_str(row, cat_keys)
 
         if cost <= 0:
             continue
@@ -338,36 +414,35 @@ def parse_expense_data(expense_csv_text):
         })
 
     # Build item-level cost lookup (unit cost = total / qty)
-    item_costs = {}
-    category_costs = {}
+    item_costs = defaultdict(lambda: [0, 0])  # name -> [total_cost, total_qty]
+    category_costs = defaultdict(int)
     general_expenses = 0
 
     for er in expense_rows:
-        name_key = er['name'].lower().strip()
-        cat_key = er['category'].lower().strip()
+        name_key = _match_key(er['name'])
+        cat_key = _match_key(er['category'])
 
         if name_key:
             # Per-item cost: store as unit cost
-            if name_key not in item_costs:
-                item_costs[name_key] = {'total_cost': 0, 'total_qty': 0}
-            item_costs[name_key]['total_cost'] += er['cost']
-            item_costs[name_key]['total_qty'] += er['quantity']
+            b = item_costs[name_key]
+            b[0] += er['cost']
+            b[1] += er['quantity']
         elif cat_key:
             # Category-level expense
-            category_costs[cat_key] = category_costs.get(cat_key, 0) + er['cost']
+            category_costs[cat_key] += er['cost']
         else:
             # General overhead
             general_expenses += er['cost']
 
     # Convert to unit costs
     unit_costs = {}
-    for name_key, data in item_costs.items():
-        if data['total_qty'] > 0:
-            unit_costs[name_key] = data['total_cost'] / data['total_qty']
+    for name_key, (total_cost, total_qty) in item_costs.items():
+        if total_qty > 0:
+            unit_costs[name_key] = total_cost / total_qty
         else:
-            unit_costs[name_key] = data['total_cost']
+            unit_costs[name_key] = total_cost
 
-    return unit_costs, category_costs, general_expenses, expense_rows
+    return unit_costs, dict(category_costs), general_expenses, expense_rows
 
 
 def apply_expense_data(normalized_rows, unit_costs, category_costs):
@@ -381,8 +456,8 @@ def apply_expense_data(normalized_rows, unit_costs, category_costs):
         if r['cost'] > 0:
             continue  # Already has cost from sales data — don't override
 
-        item_key = r['item'].lower().strip()
-        cat_key = r['category'].lower().strip()
+        item_key = _match_key(r['item'])
+        cat_key = _match_key(r['category'])
         qty = r['quantity'] or 1
 
         # Try exact item name match
@@ -430,31 +505,40 @@ def parse_stocktake(csv_text):
     Returns: {true_cogs, opening_stock_value, closing_stock_value, purchases_value}
     or None if not parseable.
     """
-    rows, _, _ = parse_csv_text(csv_text)
+    rows, _, headers = parse_csv_text(csv_text)
     if not rows:
         return None
 
+    hmap = _header_map(headers)
+    cost_keys      = _resolve_keys(hmap, _STOCKTAKE_COST_COLS, currency=True)
+    open_val_keys  = _resolve_keys(hmap, _STOCKTAKE_OPEN_VAL_COLS, currency=True)
+    close_val_keys = _resolve_keys(hmap, _STOCKTAKE_CLOSE_VAL_COLS, currency=True)
+    purch_val_keys = _resolve_keys(hmap, _STOCKTAKE_PURCH_VAL_COLS, currency=True)
+    open_keys      = _resolve_keys(hmap, _STOCKTAKE_OPEN_COLS, currency=True)
+    close_keys     = _resolve_keys(hmap, _STOCKTAKE_CLOSE_COLS, currency=True)
+    purch_keys     = _resolve_keys(hmap, _STOCKTAKE_PURCH_COLS, currency=True)
+
     opening_total = 0
     purchases_total = 0
     closing_total = 0
 
     for row in rows:
-        unit_cost = _flex_num(row, _STOCKTAKE_COST_COLS)
+        unit_cost = _flex_num(row, cost_keys)
 
         # Try direct value columns first
-        open_val  = _flex_num(row, _STOCKTAKE_OPEN_VAL_COLS)
-        close_val = _flex_num(row, _STOCKTAKE_CLOSE_VAL_COLS)
-        purch_val = _flex_num(row, _STOCKTAKE_PURCH_VAL_COLS)
+        open_val  = _flex_num(row, open_val_keys)
+        close_val = _flex_num(row, close_val_keys)
+        purch_val = _flex_num(row, purch_val_keys)
 
         # Fall back to qty × unit_cost
         if open_val == 0:
-            open_qty  = _flex_num(row, _STOCKTAKE_OPEN_COLS)
+            open_qty  = _flex_num(row, open_keys)
             open_val  = open_qty * unit_cost if unit_cost else open_qty
         if close_val == 0:
-            close_qty  = _flex_num(row, _STOCKTAKE_CLOSE_COLS)
+            close_qty  = _flex_num(row, close_keys)
             close_val  = close_qty * unit_cost if unit_cost else close_qty
         if purch_val == 0:
-            purch_qty  = _flex_num(row, _STOCKTAKE_PURCH_COLS)
+            purch_qty  = _flex_num(row, purch_keys)
             purch_val  = purch_qty * unit_cost if unit_cost else purch_qty
 
         opening_total   += open_val
@@ -490,17 +574,22 @@ def parse_payroll(csv_text):
     Returns: {total_labour, pay_runs, total_hours}
     or None if not parseable.
     """
-    rows, _, _ = parse_csv_text(csv_text)
+    rows, _, headers = parse_csv_text(csv_text)
     if not rows:
         return None
 
+    hmap = _header_map(headers)
+    pay_keys   = _resolve_keys(hmap, _PAYROLL_PAY_COLS, currency=True)
+    hours_keys = _resolve_keys(hmap, _PAYROLL_HOURS_COLS, currency=True)
+    date_keys  = _resolve_keys(hmap, _PAYROLL_DATE_COLS)
+
     total_labour = 0
     total_hours  = 0
     pay_run_dates = set()
 
     for row in rows:
-        pay   = _flex_num(row, _PAYROLL_PAY_COLS)
-        hours = _flex_num(row, _PAYROLL_HOURS_COLS)
+        pay   = _flex_num(row, pay_keys)
+        hours = _flex_num(row, hours_keys)
 
         if pay <= 0:
             continue
@@ -508,7 +597,7 @@ def parse_payroll(csv_text):
         total_labour += pay
         total_hours  += hours
 
-        date_val = _flex_str(row, _PAYROLL_DATE_COLS)
+        date_val = _flex_str(row, date_keys)
         if date_val:
             pay_run_dates.add(date_val)
 
@@ -565,27 +654,31 @@ def parse_bank_transactions(csv_text):
     Returns: {total_expenses, categories, skipped_settlements}
     or None if not parseable.
     """
-    rows, _, _ = parse_csv_text(csv_text)
+    rows, _, headers = parse_csv_text(csv_text)
     if not rows:
         return None
 
+    hmap = _header_map(headers)
+    desc_keys  = _resolve_keys(hmap, _BANK_DESC_COLS)
+    debit_keys = _resolve_keys(hmap, _BANK_DEBIT_COLS, currency=True)
+    # First signed single-amount column, if any
+    amt_key = next((i for i, h in enumerate(headers) if isinstance(h, str)
+                    and _norm_header(h) in _BANK_AMT_COLS), None)
+
     total_expenses = 0
     categories    = {cat: 0 for cat in _BANK_CATEGORIES}
     categories['Other'] = 0
     skipped = 0
 
     for row in rows:
-        desc  = _flex_str(row, _BANK_DESC_COLS).lower()
-        debit = abs(_flex_num(row, _BANK_DEBIT_COLS))
+        desc  = _flex_str(row, desc_keys).lower()
+        debit = abs(_flex_num(row, debit_keys))
 
         # Handle signed single-amount column (negative = expense for some banks)
-        if debit == 0:
-            for k in row:
-                if k.strip().lower().replace(' ', '_') in _BANK_AMT_COLS:
-                    raw = _parse_num(row[k])
-                    if raw is not None and raw < 0:
-                        debit = abs(raw)
-                    break
+        if debit == 0 and amt_key is not None:
+            raw = _parse_num(row[amt_key])
+            if raw is not None and raw < 0:
+                debit = abs(raw)
 
         if debit <= 0:
             continue  # credit or zero row — not an expense
@@ -619,16 +712,44 @@ def parse_bank_transactions(csv_text):
 
 # ─── Financial Engine ────────────────────────────────────────────────────────
 
+# Breakdown caps applied to /api/analyze responses unless ?full=1 is passed
+MAX_DAILY_DAYS = 90
+MAX_CATEGORIES = 20
+
+# Pulls every field the aggregation loop needs from a normalized row in one C call
+_ROW_FIELDS = itemgetter('revenue', 'cost', 'quantity', 'item', 'category', 'date')
+# Transaction count slot of a daily bucket
+_TXNS = itemgetter(2)
+
+
+def _new_bucket():
+    # Items/categories: [revenue, cost, quantity] — profit is revenue - cost, derived on output
+    # Days: [revenue, cost, transactions]
+    return [0, 0, 0]
+
+
+def _bucket_out(b):
+    # _r leaves ints untouched, so quantity keeps its type
+    return {'revenue': _r(b[0]), 'cost': _r(b[1]), 'quantity': _r(b[2]), 'profit': _r(b[0] - b[1])}
+
+
+def _item_out(name, b):
+    return {'name': name, **_bucket_out(b)}
+
+
 def compute_metrics(normalized_rows, fixed_costs=0, time_period_months=1,
-                    stocktake=None, payroll=None, bank=None):
+                    stocktake=None, payroll=None, bank=None, truncate=False):
     """
-    Compute cafe financial metrics from normalized rows.
+    Compute cafe financial metrics from normalized rows (any iterable, consumed once).
     Each row: { item, category, quantity, revenue (total), cost (total), date }
+    Rows with neither an item nor revenue are skipped and not counted.
     time_period_months: how many months the data covers (for projections).
     fixed_costs: monthly fixed costs — will be multiplied by time_period_months.
     stocktake: result of parse_stocktake() or None
     payroll: result of parse_payroll() or None
     bank: result of parse_bank_transactions() or None
+    truncate: cap the 'daily' and 'categories' breakdowns (see MAX_DAILY_DAYS,
+              MAX_CATEGORIES); the summary always covers the full data.
     """
     tp = max(time_period_months, 1)
     monthly_fixed = fixed_costs
@@ -636,18 +757,16 @@ def compute_metrics(normalized_rows, fixed_costs=0, time_period_months=1,
     total_revenue = 0
     total_cogs = 0
     total_units = 0
-    items = {}
-    categories = {}
-    daily = {}
-
-    for r in normalized_rows:
-        rev = r['revenue']
-        cog = r['cost']
-        qty = r['quantity']
-        item = r['item']
-        cat = r['category']
-        date = r['date']
-        profit = rev - cog
+    rows_processed = 0
+    # List accumulators (see _new_bucket), projected to dicts on output
+    items = defaultdict(_new_bucket)
+    categories = defaultdict(_new_bucket)
+    daily = defaultdict(_new_bucket)
+
+    for rev, cog, qty, item, cat, date in map(_ROW_FIELDS, normalized_rows):
+        if not item and rev <= 0:
+            continue
+        rows_processed += 1
 
         total_revenue += rev
         total_cogs += cog
@@ -655,29 +774,24 @@ def compute_metrics(normalized_rows, fixed_costs=0, time_period_months=1,
 
         # Per-item breakdown
         if item:
-            if item not in items:
-                items[item] = {'revenue': 0, 'cost': 0, 'quantity': 0, 'profit': 0}
-            items[item]['revenue'] += rev
-            items[item]['cost'] += cog
-            items[item]['quantity'] += qty
-            items[item]['profit'] += profit
+            b = items[item]
+            b[0] += rev
+            b[1] += cog
+            b[2] += qty
 
         # Per-category breakdown
         if cat:
-            if cat not in categories:
-                categories[cat] = {'revenue': 0, 'cost': 0, 'quantity': 0, 'profit': 0}
-            categories[cat]['revenue'] += rev
-            categories[cat]['cost'] += cog
-            categories[cat]['quantity'] += qty
-            categories[cat]['profit'] += profit
+            b = categories[cat]
+            b[0] += rev
+            b[1] += cog
+            b[2] += qty
 
         # Daily breakdown
         if date:
-            if date not in daily:
-                daily[date] = {'revenue': 0, 'cost': 0, 'transactions': 0}
-            daily[date]['revenue'] += rev
-            daily[date]['cost'] += cog
-            daily[date]['transactions'] += 1
+            b = daily[date]
+            b[0] += rev
+            b[1] += cog
+            b[2] += 1
 
     gross_profit = total_revenue - total_cogs
     gross_margin = (gross_profit / total_revenue * 100) if total_revenue else 0
@@ -708,14 +822,40 @@ def compute_metrics(normalized_rows, fixed_costs=0, time_period_months=1,
     bank_expenses   = bank['total_expenses'] if bank else 0
     expense_categories = bank['categories'] if bank else {}
 
-    # Top items by profit
-    top_items = sorted(items.items(), key=lambda x: x[1]['profit'], reverse=True)[:10]
-    worst_items = sorted(items.items(), key=lambda x: x[1]['profit'])[:5]
+    # Top items by profit — heap selection of k items instead of a full sort.
+    # Plain tuples compare in C; the insertion index keeps ties in first-seen order.
+    top_items = [name for _, _, name in heapq.nlargest(
+        10, [(b[0] - b[1], -i, name) for i, (name, b) in enumerate(items.items())])]
+    worst_items = [name for _, _, name in heapq.nsmallest(
+        5, [(b[0] - b[1], i, name) for i, (name, b) in enumerate(items.items())])]
+
+    # Response size caps — keep the most recent days and the biggest categories
+    truncated = truncate and (len(daily) > MAX_DAILY_DAYS or len(categories) > MAX_CATEGORIES)
+    if truncate and len(categories) > MAX_CATEGORIES:
+        top_cats = heapq.nlargest(
+            MAX_CATEGORIES, [(b[0], -i, cat) for i, (cat, b) in enumerate(categories.items())])
+        category_rows = [(cat, categories[cat]) for _, _, cat in top_cats]
+        # Roll the dropped categories into one bucket so the breakdown still adds up
+        kept = {cat for cat, _ in category_rows}
+        other = _new_bucket()
+        for cat, b in categories.items():
+            if cat not in kept:
+                other[0] += b[0]
+                other[1] += b[1]
+                other[2] += b[2]
+        categories_other = {'count': len(categories) - len(kept), **_bucket_out(other)}
+    else:
+        category_rows = sorted(categories.items(), key=lambda x: x[1][0], reverse=True)
+        categories_other = None
+    if truncate and len(daily) > MAX_DAILY_DAYS:
+        daily_rows = [(d, daily[d]) for d in heapq.nlargest(MAX_DAILY_DAYS, daily)[::-1]]
+    else:
+        daily_rows = sorted(daily.items())
 
     # Daily averages
     num_days = len(daily) or 1
     avg_daily_revenue = total_revenue / num_days
-    avg_daily_transactions = sum(d['transactions'] for d in daily.values()) / num_days
+    avg_daily_transactions = sum(map(_TXNS, daily.values())) / num_days
 
     # Monthly and annual projections
     monthly_revenue = total_revenue / tp
@@ -745,6 +885,7 @@ def compute_metrics(normalized_rows, fixed_costs=0, time_period_months=1,
             'avg_daily_revenue': _r(avg_daily_revenue),
             'avg_daily_transactions': _r(avg_daily_transactions),
             'time_period_months': tp,
+            'rows_processed': rows_processed,
             'monthly_revenue': _r(monthly_revenue),
             'monthly_cogs': _r(monthly_cogs),
             'monthly_gross_profit': _r(monthly_gross_profit),
@@ -762,141 +903,216 @@ def compute_metrics(normalized_rows, fixed_costs=0, time_period_months=1,
             'prime_cost_pct': _r(prime_cost_pct),
             'bank_expenses': _r(bank_expenses),
         },
-        'top_items': [
-            {'name': name, **{k: _r(v) if isinstance(v, float) else v for k, v in data.items()}}
-            for name, data in top_items
-        ],
-        'worst_items': [
-            {'name': name, **{k: _r(v) if isinstance(v, float) else v for k, v in data.items()}}
-            for name, data in worst_items
-        ],
-        'categories': {
-            cat: {k: _r(v) if isinstance(v, float) else v for k, v in data.items()}
-            for cat, data in sorted(categories.items(), key=lambda x: x[1]['revenue'], reverse=True)
-        },
+        'top_items': [_item_out(name, items[name]) for name in top_items],
+        'worst_items': [_item_out(name, items[name]) for name in worst_items],
+        'categories': {cat: _bucket_out(b) for cat, b in category_rows},
+        'categories_other': categories_other,
         'daily': {
-            date: {k: _r(v) if isinstance(v, float) else v for k, v in data.items()}
-            for date, data in sorted(daily.items())
+            date: {'revenue': _r(b[0]), 'cost': _r(b[1]), 'transactions': b[2]}
+            for date, b in daily_rows
         },
         'expense_categories': expense_categories,
+        'truncated': truncated,
     }
 
 
 # ─── Groq AI ───────────────────────────────────────────────────────────
 
+GROQ_SYSTEM_PROMPT = (
+    'You are a friendly, experienced cafe business advisor having a conversation '
+    'with a cafe owner. Write in a warm, approachable tone — like a mentor giving advice over coffee. '
+    'Use plain language, avoid jargon. Be specific with numbers from the data. '
+    'Structure your response with these exact emoji headers on their own line:\n'
+    '🔥 Quick Wins\n💰 Pricing Tips\n📋 Menu Moves\n✂️ Cut Costs\n📈 Grow Revenue\n💡 Pro Tip\n'
+    'Under each header, write 2-3 short conversational paragraphs (not bullet lists). '
+    'Start each section with the most impactful advice. Keep it practical and encouraging. '
+    'End with a single motivating sentence.'
+)
+
+# Pre-encoded chat completion body around the user content:
+# PREFIX + json(prompt) + MIDDLE + max_tokens + '}'
+_GROQ_BODY_PREFIX = (
+    '{"model": ' + json.dumps(GROQ_MODEL)
+    + ', "temperature": 0.4, "messages": [{"role": "system", "content": '
+    + json.dumps(GROQ_SYSTEM_PROMPT)
+    + '}, {"role": "user", "content": '
+).encode()
+_GROQ_BODY_MIDDLE = b'}], "max_tokens": '
+
+# Module-level keep-alive connection: on a serverless platform it survives
+# for the lifetime of a warm container instance, skipping the TLS handshake.
+# http.client connections aren't thread-safe, so use is guarded by _groq_lock.
+_groq_conn = None
+_groq_lock = threading.Lock()
+
+
+def _groq_connection():
+    """Return the shared Groq HTTPS connection, creating it lazily."""
+    global _groq_conn
+    if _groq_conn is None:
+        _groq_conn = http.client.HTTPSConnection(GROQ_HOST, timeout=15)
+    return _groq_conn
+
+
+def _reset_groq_connection():
+    """Drop the shared connection so the next call reconnects."""
+    global _groq_conn
+    if _groq_conn is not None:
+        _groq_conn.close()
+        _groq_conn = None
+
+
+def _groq_post(conn, body, headers):
+    """POST a chat completion on conn; returns (status, reason, raw_body)."""
+    try:
+        conn.request('POST', GROQ_PATH, body=body, headers=headers)
+        resp = conn.getresponse()
+    except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+        # Idle keep-alive socket was closed by the server — reconnect once
+        conn.close()
+        conn.request('POST', GROQ_PATH, body=body, headers=headers)
+        resp = conn.getresponse()
+    return resp.status, resp.reason, resp.read()
+
+
 def call_groq(prompt, max_tokens=600):
     """Call Groq API (free tier: 30 req/min, 14,400/day)."""
     if not GROQ_API_KEY:
         return None
 
-    body = json.dumps({
-        'model': GROQ_MODEL,
-        'messages': [
-            {
-                'role': 'system',
-                'content': (
-                    'You are a friendly, experienced cafe business advisor having a conversation '
-                    'with a cafe owner. Write in a warm, approachable tone — like a mentor giving advice over coffee. '
-                    'Use plain language, avoid jargon. Be specific with numbers from the data. '
-                    'Structure your response with these exact emoji headers on their own line:\n'
-                    '🔥 Quick Wins\n💰 Pricing Tips\n📋 Menu Moves\n✂️ Cut Costs\n📈 Grow Revenue\n💡 Pro Tip\n'
-                    'Under each header, write 2-3 short conversational paragraphs (not bullet lists). '
-                    'Start each section with the most impactful advice. Keep it practical and encouraging. '
-                    'End with a single motivating sentence.'
-                ),
-            },
-            {'role': 'user', 'content': prompt},
-        ],
-        'max_tokens': max_tokens,
-        'temperature': 0.4,
-    }).encode()
-
-    req = urllib.request.Request(
-        'https://api.groq.com/openai/v1/chat/completions',
-        data=body,
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {GROQ_API_KEY}',
-            'User-Agent': 'AI-Cafe-Analyst/2.0',
-        },
-    )
+    # Only the user prompt and max_tokens are serialized per call
+    body = b''.join((
+        _GROQ_BODY_PREFIX,
+        json.dumps(prompt).encode(),
+        _GROQ_BODY_MIDDLE,
+        str(int(max_tokens)).encode(),
+        b'}',
+    ))
+
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': f'Bearer {GROQ_API_KEY}',
+        'User-Agent': 'AI-Cafe-Analyst/2.0',
+        'Connection': 'keep-alive',
+    }
     try:
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            data = json.loads(resp.read())
-            return data['choices'][0]['message']['content']
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode() if e.fp else ''
-        return f'AI analysis unavailable: {e} — {error_body}'
+        if _groq_lock.acquire(blocking=False):
+            try:
+                status, reason, raw = _groq_post(_groq_connection(), body, headers)
+            except Exception:
+                _reset_groq_connection()
+                raise
+            finally:
+                _groq_lock.release()
+        else:
+            # Shared connection is busy with a concurrent request — don't queue behind it
+            conn = http.client.HTTPSConnection(GROQ_HOST, timeout=15)
+            try:
+                status, reason, raw = _groq_post(conn, body, headers)
+            finally:
+                conn.close()
+
+        if status >= 400:
+            return f'{_AI_ERROR_PREFIX}: HTTP Error {status}: {reason} — {raw.decode(errors="replace")}'
+        data = json.loads(raw)
+        return data['choices'][0]['message']['content']
     except Exception as e:
-        return f'AI analysis unavailable: {e}'
+        return f'{_AI_ERROR_PREFIX}: {e}'
+
+
+def get_ai_recommendations(prompt):
+    """
+    Return (text, cache_hit) for a prompt. Identical uploads produce identical
+    prompts, so successful Groq responses are served from the in-process cache.
+    """
+    if not GROQ_API_KEY:
+        return None, False
+
+    key = hashlib.blake2b(prompt.encode(), digest_size=16).hexdigest()
+    with _ai_cache_lock:
+        cached = _ai_cache.get(key)
+        if cached is not None:
+            _ai_cache.move_to_end(key)
+            return cached, True
+
+    # Network call happens outside the lock
+    text = call_groq(prompt)
+    # Only cache real answers — errors should be retried
+    if text and not text.startswith(_AI_ERROR_PREFIX):
+        with _ai_cache_lock:
+            _ai_cache[key] = text
+            if len(_ai_cache) > AI_CACHE_SIZE:
+                _ai_cache.popitem(last=False)
+    return text, False
 
 
 def build_prompt(metrics):
     """Build a detailed prompt from computed metrics."""
     s = metrics['summary']
-    top = metrics.get('top_items', [])[:5]
-    worst = metrics.get('worst_items', [])[:3]
-
-    top_str = '\n'.join(
-        f"  - {i['name']}: revenue ${i['revenue']}, cost ${i['cost']}, profit ${i['profit']}, qty {i['quantity']}"
-        for i in top
-    )
-    worst_str = '\n'.join(
-        f"  - {i['name']}: revenue ${i['revenue']}, cost ${i['cost']}, profit ${i['profit']}, qty {i['quantity']}"
-        for i in worst
-    )
-
-    cat_str = '\n'.join(
+    tp = s.get('time_period_months', 1)
+
+    parts = [
+        "Analyze this cafe's financial data and provide 6-8 specific, prioritized recommendations.\n"
+        f"\nDATA PERIOD: {tp} month(s) of data\n"
+        "\nFINANCIAL SUMMARY (for the full period):\n"
+        f"- Total Revenue: ${s['total_revenue']}\n"
+        f"- Total COGS: ${s['total_cogs']}{' (from stocktake)' if s.get('cogs_source') == 'stocktake' else ' (from POS)'}\n"
+        f"- Gross Profit: ${s['gross_profit']} (Margin: {s['gross_margin_pct']}%)\n"
+        f"- Fixed Costs: ${s['fixed_costs']} (${s.get('monthly_fixed_costs', s['fixed_costs'])}/month × {tp} months)\n"
+        f"- Net Profit: ${s['net_profit']} (Margin: {s['net_margin_pct']}%)\n"
+        f"- Food Cost %: {s['food_cost_pct']}%\n"
+        f"- Avg Order Value: ${s['avg_order_value']}\n"
+        f"- Break-even: {s['break_even_units']} units\n"
+        f"- Avg Daily Revenue: ${s['avg_daily_revenue']}\n"
+        f"- Avg Daily Transactions: {s['avg_daily_transactions']}\n",
+        f"- Labour Cost: ${s['labour_cost']} ({s['labour_pct']}% of revenue) — Industry benchmark: 30–35%"
+        if s.get('labour_cost') else '',
+        '\n',
+        f"- Prime Cost (COGS + Labour): ${s['prime_cost']} ({s['prime_cost_pct']}% of revenue) — Industry benchmark: <60%"
+        if s.get('prime_cost') else '',
+        '\n'
+        '\nMONTHLY AVERAGES:\n'
+        f"- Monthly Revenue: ${s.get('monthly_revenue', s['total_revenue'])}\n"
+        f"- Monthly COGS: ${s.get('monthly_cogs', s['total_cogs'])}\n"
+        f"- Monthly Net Profit: ${s.get('monthly_net_profit', s['net_profit'])}\n"
+        '\nANNUAL PROJECTIONS:\n'
+        f"- Annual Revenue: ${s.get('annual_revenue', s['total_revenue'])}\n"
+        f"- Annual Net Profit: ${s.get('annual_net_profit', s['net_profit'])}\n"
+        '\nTOP SELLING ITEMS:\n',
+    ]
+    _item_lines(parts, metrics.get('top_items', [])[:5])
+    parts.append('\nLOWEST PERFORMING ITEMS:\n')
+    _item_lines(parts, metrics.get('worst_items', [])[:3])
+    parts.append('\nCATEGORY BREAKDOWN:\n')
+    # Categories arrive sorted by revenue; the prompt only needs the top ones
+    # (also keeps ?full=1 and capped responses on the same AI cache key)
+    parts.append('\n'.join([
         f"  - {cat}: revenue ${d['revenue']}, cost ${d['cost']}, profit ${d['profit']}"
-        for cat, d in metrics.get('categories', {}).items()
-    )
+        for cat, d in itertools.islice(metrics.get('categories', {}).items(), MAX_CATEGORIES)
+    ]))
+    parts.append('\n')
 
     exp_cats = metrics.get('expense_categories', {})
-    expense_str = ''
     if exp_cats:
-        expense_str = '\nBANK EXPENSE BREAKDOWN:\n' + '\n'.join(
-            f"  - {cat}: ${amt}" for cat, amt in exp_cats.items()
-        )
-
-    return f"""Analyze this cafe's financial data and provide 6-8 specific, prioritized recommendations.
-
-DATA PERIOD: {s.get('time_period_months', 1)} month(s) of data
-
-FINANCIAL SUMMARY (for the full period):
-- Total Revenue: ${s['total_revenue']}
-- Total COGS: ${s['total_cogs']}{' (from stocktake)' if s.get('cogs_source') == 'stocktake' else ' (from POS)'}
-- Gross Profit: ${s['gross_profit']} (Margin: {s['gross_margin_pct']}%)
-- Fixed Costs: ${s['fixed_costs']} (${s.get('monthly_fixed_costs', s['fixed_costs'])}/month × {s.get('time_period_months', 1)} months)
-- Net Profit: ${s['net_profit']} (Margin: {s['net_margin_pct']}%)
-- Food Cost %: {s['food_cost_pct']}%
-- Avg Order Value: ${s['avg_order_value']}
-- Break-even: {s['break_even_units']} units
-- Avg Daily Revenue: ${s['avg_daily_revenue']}
-- Avg Daily Transactions: {s['avg_daily_transactions']}
-{f"- Labour Cost: ${s['labour_cost']} ({s['labour_pct']}% of revenue) — Industry benchmark: 30–35%" if s.get('labour_cost') else ''}
-{f"- Prime Cost (COGS + Labour): ${s['prime_cost']} ({s['prime_cost_pct']}% of revenue) — Industry benchmark: <60%" if s.get('prime_cost') else ''}
-
-MONTHLY AVERAGES:
-- Monthly Revenue: ${s.get('monthly_revenue', s['total_revenue'])}
-- Monthly COGS: ${s.get('monthly_cogs', s['total_cogs'])}
-- Monthly Net Profit: ${s.get('monthly_net_profit', s['net_profit'])}
-
-ANNUAL PROJECTIONS:
-- Annual Revenue: ${s.get('annual_revenue', s['total_revenue'])}
-- Annual Net Profit: ${s.get('annual_net_profit', s['net_profit'])}
-
-TOP SELLING ITEMS:
-{top_str}
-
-LOWEST PERFORMING ITEMS:
-{worst_str}
+        parts.append('\nBANK EXPENSE BREAKDOWN:\n')
+        parts.append('\n'.join([f"  - {cat}: ${amt}" for cat, amt in exp_cats.items()]))
+
+    parts.append(
+        '\nIndustry benchmarks: food cost 28-32%, gross margin 65-70%, net margin 5-15%, labour 30-35%, prime cost <60%.\n'
+        '\nGive me friendly, practical advice using the emoji section headers (🔥 Quick Wins, 💰 Pricing Tips, '
+        '📋 Menu Moves, ✂️ Cut Costs, 📈 Grow Revenue, 💡 Pro Tip). Write short paragraphs, not bullet lists. '
+        'Be specific with dollar amounts and percentages from the data. Keep it encouraging and actionable.'
+    )
+    return ''.join(parts)
 
-CATEGORY BREAKDOWN:
-{cat_str}
-{expense_str}
-Industry benchmarks: food cost 28-32%, gross margin 65-70%, net margin 5-15%, labour 30-35%, prime cost <60%.
 
-Give me friendly, practical advice using the emoji section headers (🔥 Quick Wins, 💰 Pricing Tips, 📋 Menu Moves, ✂️ Cut Costs, 📈 Grow Revenue, 💡 Pro Tip). Write short paragraphs, not bullet lists. Be specific with dollar amounts and percentages from the data. Keep it encouraging and actionable."""
+def _item_lines(parts, items):
+    """Append '  - name: revenue ..., qty N' lines (newline-separated) to parts."""
+    parts.append('\n'.join([
+        f"  - {i['name']}: revenue ${i['revenue']}, cost ${i['cost']}, profit ${i['profit']}, qty {i['quantity']}"
+        for i in items
+    ]))
+    parts.append('\n')
 
 
 # ─── Helpers ──────────────────────────────────────────────────────────────────
@@ -909,49 +1125,94 @@ _CURRENCY_SUFFIXES = (
 )
 
 
-def _flex_num(row, key_options):
-    """Extract a numeric value from a row, trying multiple possible column names.
-    Also handles currency-suffixed variants (e.g. amount_aud matches 'amount')."""
-    for k in key_options:
-        for rk in row:
-            rk_norm = rk.strip().lower().replace(' ', '_')
-            if rk_norm == k:
-                v = _parse_num(row[rk])
-                if v is not None:
-                    return v
-    # Fallback: try stripping currency suffix from column names
+_HEADER_TRANS = str.maketrans(' \t', '__')
+
+
+@lru_cache(maxsize=1024)
+def _norm_header(h):
+    """Normalize a column header for alias matching: 'Gross Sales ' -> 'gross_sales'."""
+    return h.strip().lower().translate(_HEADER_TRANS)
+
+
+@lru_cache(maxsize=4096)
+def _match_key(name):
+    """Case/space-insensitive key for matching item and category names across files."""
+    return name.lower().strip()
+
+
+def _header_map(headers):
+    """Map normalized header names to their column positions, in column order."""
+    hmap = {}
+    for i, h in enumerate(headers):
+        if isinstance(h, str):
+            hmap.setdefault(_norm_header(h), []).append(i)
+    return hmap
+
+
+def _resolve_keys(hmap, key_options, currency=False):
+    """
+    Resolve candidate column names against a header map (see _header_map),
+    returning column positions in lookup priority order.
+    With currency=True, currency-suffixed variants are appended as a fallback
+    (e.g. amount_aud matches 'amount').
+    """
+    keys = []
     for k in key_options:
-        for rk in row:
-            rk_norm = rk.strip().lower().replace(' ', '_')
-            for sfx in _CURRENCY_SUFFIXES:
-                if rk_norm == k + sfx or (rk_norm.endswith(sfx) and rk_norm[:-len(sfx)] == k):
-                    v = _parse_num(row[rk])
-                    if v is not None:
-                        return v
+        keys.extend(hmap.get(k, ()))
+    if currency:
+        for k in key_options:
+            suffixed = {k + sfx for sfx in _CURRENCY_SUFFIXES}
+            for norm, originals in hmap.items():
+                if norm in suffixed:
+                    keys.extend(originals)
+    return keys
+
+
+def _flex_num(row, keys):
+    """Extract a numeric value from a row, trying resolved column positions in order."""
+    for rk in keys:
+        v = _parse_num(row[rk])
+        if v is not None:
+            return v
     return 0
 
 
+# Drop currency symbols / thousands separators, accounting negatives "(5.00)" -> "-5.00"
+_NUM_TRANS = str.maketrans({'$': None, '€': None, '£': None, ',': None, '(': '-', ')': None})
+_NUM_BLANKS = frozenset(('nan', 'n/a', '', '-', '--'))
+
+
 def _parse_num(raw):
     """Parse a raw cell value into a float, or return None."""
+    if raw is None:
+        return None
+    if type(raw) is int or type(raw) is float:
+        # JSON rows can carry real numbers — skip the string round-trip
+        return float(raw) if raw == raw else None
+    if type(raw) is str:
+        # Clean numeric cells (the common case) parse straight in C;
+        # only formatted ones ("$1,200", "(5.00)", "N/A") take the cleanup path
+        try:
+            v = float(raw)
+        except ValueError:
+            pass
+        else:
+            return v if v == v else None
     try:
-        val = str(raw).strip()
-        val = val.replace('$', '').replace(',', '').replace('(', '-').replace(')', '')
-        val = val.strip()
-        if not val or val.lower() in ('nan', 'n/a', '', '-', '--'):
+        val = str(raw).strip().translate(_NUM_TRANS).strip()
+        if val.lower() in _NUM_BLANKS:
             return None
         return float(val)
     except (ValueError, TypeError):
         return None
 
 
-def _flex_str(row, key_options):
-    """Extract a string value from a row, trying multiple possible column names."""
-    for k in key_options:
-        for rk in row:
-            if rk.strip().lower().replace(' ', '_') == k:
-                v = str(row[rk]).strip()
-                if v and v.lower() not in ('nan', 'n/a', 'none', ''):
-                    return v
+def _flex_str(row, keys):
+    """Extract a string value from a row, trying resolved column positions in order."""
+    for rk in keys:
+        v = str(row[rk]).strip()
+        if v and v.lower() not in ('nan', 'n/a', 'none', ''):
+            return v
     return ''
 
 
@@ -959,68 +1220,106 @@ def _r(n):
     return round(n, 2)
 
 
+_NON_SPACE = re.compile(r'\S')
+CSV_SNIFF_BYTES = 4096
+CSV_DELIMITERS = ',\t;|'
+_SNIFFER = csv.Sniffer()
+
+# ';'-delimited exports (European POS locales) write "4,50" and "1.234,56".
+# A cell that is a whole number in that notation, optionally wrapped in a
+# currency symbol or accounting parens, is rewritten to "4.50" / "1234.56".
+_DECIMAL_COMMA = re.compile(r'\d,\d')
+_COMMA_NUM = re.compile(
+    r'([(+-]?[^\d\s.,]{0,3})\s?(\d{1,3}(?:[. \xa0\u202f]\d{3})+|\d+)(?:,(\d+))?\s?([^\d\s.,]{0,3}\)?)')
+_THOUSANDS_SEPS = str.maketrans('', '', '. \xa0\u202f')
+
+
+def _comma_decimal(v):
+    """'4,50' -> '4.50', '1.234,56' -> '1234.56'; other cells are returned unchanged."""
+    m = _COMMA_NUM.fullmatch(v.strip())
+    if not m:
+        return v
+    prefix, whole, frac, suffix = m.groups()
+    if frac is None and whole.isdecimal():
+        return v  # plain integer, nothing to convert
+    whole = whole.translate(_THOUSANDS_SEPS)
+    return f"{prefix}{whole}.{frac}{suffix}" if frac is not None else f"{prefix}{whole}{suffix}"
+
+
 def parse_csv_text(text):
     """
-    Parse CSV text into list of dicts using Python's csv module.
+    Parse CSV text using Python's csv module into (rows, pos_format, headers).
+    Each row is a list of cell values aligned with headers (short rows padded
+    with ''); use _header_map/resolve_columns to find columns by position.
     Handles quoted fields with commas, various delimiters, BOM, etc.
     """
-    # Strip BOM if present
-    if text.startswith('\ufeff'):
-        text = text[1:]
-
-    text = text.strip()
-    if not text:
-        return [], 'generic'
-
-    # Detect delimiter (tab vs comma)
-    first_line = text.split('\n')[0]
-    dialect = 'excel'
-    delimiter = ','
-    if first_line.count('\t') > first_line.count(','):
-        delimiter = '\t'
-
-    reader = csv.DictReader(io.StringIO(text), delimiter=delimiter)
+    # Skip BOM and leading blank space by offset — no copies of the full text
+    start = 1 if text.startswith('\ufeff') else 0
+    m = _NON_SPACE.search(text, start)
+    if not m:
+        return [], 'generic', []
+    start = m.start()
+
+    # Sniff the delimiter from a small sample, cut back to whole lines so a
+    # truncated last row doesn't skew it; handles ';' (European Square) and '|'
+    sample = text[start:start + CSV_SNIFF_BYTES]
+    if len(text) - start > CSV_SNIFF_BYTES:
+        sample = sample[:sample.rfind('\n') + 1] or sample
+    try:
+        delimiter = _SNIFFER.sniff(sample, delimiters=CSV_DELIMITERS).delimiter
+    except csv.Error:
+        # Fall back to tab vs comma on the header line
+        end = text.find('\n', start)
+        first_line = text[start:end] if end >= 0 else text[start:]
+        delimiter = '\t' if first_line.count('\t') > first_line.count(',') else ','
+
+    # A ';' file with "4,50"-style numbers in its sample uses comma decimals;
+    # its numeric cells are converted here so _parse_num sees dot decimals
+    comma_decimal = delimiter == ';' and _DECIMAL_COMMA.search(sample) is not None
+
+    # Single pass over the text; rows stay as csv.reader's lists — no per-row dict
+    stream = io.StringIO(text)
+    stream.seek(start)
+    reader = csv.reader(stream, delimiter=delimiter)
+    headers = next(reader, [])
+    width = len(headers)
 
     rows = []
-    headers = []
-    for row in reader:
-        if not headers:
-            headers = list(row.keys())
+    for values in reader:
         # Skip completely empty rows
-        if any(v and v.strip() for v in row.values()):
-            rows.append(row)
+        if any(v.strip() for v in values):
+            if comma_decimal:
+                values = [_comma_decimal(v) if v and not v.isdecimal() else v for v in values]
+            if len(values) < width:
+                values.extend([''] * (width - len(values)))
+            rows.append(values)
 
     # Detect POS format from headers
     pos_format = detect_pos_format(headers) if headers else 'generic'
 
     # Square Summary Report: filter to "Item Sales" rows only (avoid double-counting)
     if pos_format == 'square_summary':
-        rows = _filter_square_summary(rows)
+        rows = _filter_square_summary(rows, headers)
 
     return rows, pos_format, headers
 
 
-def _filter_square_summary(rows):
+def _filter_square_summary(rows, headers):
     """
     Square Summary CSVs have sections: Summary, Payments, Category Sales, Item Sales.
     Keep only 'Item Sales' rows to get item-level detail.
     If no 'Item Sales' rows, fall back to 'Category Sales'.
     """
-    # Find the section column key (case-insensitive)
-    section_key = None
-    if rows:
-        for k in rows[0]:
-            if k.strip().lower() == 'section':
-                section_key = k
-                break
-    if not section_key:
+    # Find the section column (case-insensitive)
+    section_key = next((i for i, h in enumerate(headers) if h.strip().lower() == 'section'), None)
+    if section_key is None:
         return rows
 
-    item_rows = [r for r in rows if r.get(section_key, '').strip().lower() == 'item sales']
+    item_rows = [r for r in rows if r[section_key].strip().lower() == 'item sales']
     if item_rows:
         return item_rows
 
-    cat_rows = [r for r in rows if r.get(section_key, '').strip().lower() == 'category sales']
+    cat_rows = [r for r in rows if r[section_key].strip().lower() == 'category sales']
     if cat_rows:
         return cat_rows
 
@@ -1029,150 +1328,289 @@ def _filter_square_summary(rows):
 
 # ─── HTTP Handler ─────────────────────────────────────────────────────────
 
+# Largest request body /api/analyze will read (checked against Content-Length)
+MAX_BODY_BYTES = 20 << 20  # 20 MiB
+# Options a text/csv upload may pass in the query string
+_QUERY_OPTIONS = ('fixed_costs', 'time_period_months', 'pos_format')
+_BODY_TYPES = ('', 'application/json', 'text/csv')
+
+# Streamed responses are flushed in writes of about this size
+JSON_WRITE_BUFFER = 64 * 1024
+# Compact separators: ~10% fewer bytes on large metrics payloads
+_JSON_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+# GET /api and /api/health only change when the deployment's config does,
+# so they carry an ETag computed at import and answer If-None-Match with 304.
+_API_INFO = {
+    'name': 'AI Cafe Analyst',
+    'version': '2.0.0',
+    'status': 'online',
+    'ai_enabled': bool(GROQ_API_KEY),
+    'ai_model': GROQ_MODEL if GROQ_API_KEY else None,
+    'supported_pos': ['square', 'square_summary', 'lightspeed', 'toast', 'clover', 'shopify', 'generic'],
+    'endpoints': {
+        'POST /api/analyze': 'Upload cafe data and get financial analysis + AI recommendations',
+        'GET /api/health': 'Health check',
+    },
+}
+_HEALTH = {'status': 'healthy', 'ai': bool(GROQ_API_KEY)}
+
+
+def _etag(body):
+    return '"' + hashlib.blake2b(body, digest_size=8).hexdigest() + '"'
+
+
+def _cache_headers(etag):
+    # no-cache: clients may store it but must revalidate (cheap 304) each time
+    return {'ETag': etag, 'Cache-Control': 'no-cache'}
+
+
+# Encoded once: a GET is just a header block and a write of these bytes
+_API_INFO_BODY = _JSON_ENCODER.encode(_API_INFO).encode()
+_HEALTH_BODY = _JSON_ENCODER.encode(_HEALTH).encode()
+_API_INFO_ETAG = _etag(_API_INFO_BODY)
+_HEALTH_ETAG = _etag(_HEALTH_BODY)
+
+
+def _route_path(path):
+    """Strip the query string and trailing slash from a request path."""
+    return path.partition('?')[0].rstrip('/')
+
+
 class handler(BaseHTTPRequestHandler):
     def do_OPTIONS(self):
         self._cors(204)
 
     def do_GET(self):
-        path = self.path.split('?')[0].rstrip('/')
-
-        if path in ('', '/api', '/api/'):
-            self._json(200, {
-                'name': 'AI Cafe Analyst',
-                'version': '2.0.0',
-                'status': 'online',
-                'ai_enabled': bool(GROQ_API_KEY),
-                'ai_model': GROQ_MODEL if GROQ_API_KEY else None,
-                'supported_pos': ['square', 'square_summary', 'lightspeed', 'toast', 'clover', 'shopify', 'generic'],
-                'endpoints': {
-                    'POST /api/analyze': 'Upload cafe data and get financial analysis + AI recommendations',
-                    'GET /api/health': 'Health check',
-                },
-                'timestamp': datetime.utcnow().isoformat(),
-            })
-        elif path == '/api/health':
-            self._json(200, {'status': 'healthy', 'ai': bool(GROQ_API_KEY), 'timestamp': datetime.utcnow().isoformat()})
+        route = self.GET_ROUTES.get(_route_path(self.path))
+        if route:
+            route(self)
         else:
             self._json(404, {'error': 'Not found'})
 
     def do_POST(self):
-        path = self.path.split('?')[0].rstrip('/')
+        route = self.POST_ROUTES.get(_route_path(self.path))
+        if route:
+            route(self)
+        else:
+            self._json(404, {'error': 'Not found. Use POST /api/analyze'})
 
-        if path == '/api/analyze':
+    def _info(self):
+        if not self._not_modified(_API_INFO_ETAG):
+            self._send_bytes(200, _API_INFO_BODY, _cache_headers(_API_INFO_ETAG))
+
+    def _health(self):
+        if not self._not_modified(_HEALTH_ETAG):
+            self._send_bytes(200, _HEALTH_BODY, _cache_headers(_HEALTH_ETAG))
+
+    def _analyze(self):
+        try:
+            # Reject before reading, so one oversized upload can't exhaust the instance's memory
             try:
                 length = int(self.headers.get('Content-Length', 0))
-                body = json.loads(self.rfile.read(length)) if length else {}
-
-                csv_text = body.get('csv', '')
-                rows = body.get('rows', [])
-                fixed_costs = float(body.get('fixed_costs', 0))
-                force_format = body.get('pos_format', '')  # optional override
-                expense_csv_text = body.get('expense_csv', '')  # legacy support
-                time_period_months = float(body.get('time_period_months', 1))
-                stocktake_csv_text = body.get('stocktake_csv', '')
-                payroll_csv_text   = body.get('payroll_csv', '')
-                bank_csv_text      = body.get('bank_csv', '')
-
-                # Parse CSV if provided as text
-                pos_format = 'generic'
-                csv_headers = []
-                if csv_text and not rows:
-                    rows, pos_format, csv_headers = parse_csv_text(csv_text)
-
-                # Allow client to override detected format
-                if force_format and force_format in POS_COLUMN_MAPS:
-                    pos_format = force_format
-
-                if not rows:
-                    self._json(400, {'error': 'No data provided. Send "csv" (CSV text) or "rows" (array of objects).'})
+            except ValueError:
+                length = -1
+            if length < 0:
+                self._json(400, {'error': 'Invalid Content-Length header.'})
+                return
+            if length > MAX_BODY_BYTES:
+                self._json(413, {'error': f'Payload too large. Maximum upload is {MAX_BODY_BYTES >> 20} MB.'})
+                return
+            content_type = self.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type not in _BODY_TYPES:
+                self._json(415, {'error': 'Unsupported Content-Type. Send application/json or text/csv.'})
+                return
+
+            raw = self.rfile.read(length) if length else b''
+            query = urllib.parse.parse_qs(urllib.parse.urlsplit(self.path).query)
+            full = query.get('full', [''])[-1].lower() in ('1', 'true')
+
+            if content_type == 'text/csv':
+                # Raw CSV upload: skip the JSON round-trip, options come from the query string
+                body = {k: query[k][-1] for k in _QUERY_OPTIONS if k in query}
+                try:
+                    body['csv'] = raw.decode('utf-8')
+                except UnicodeDecodeError:
+                    self._json(400, {'error': 'CSV body must be UTF-8 encoded.'})
                     return
-
-                # Normalize all rows to standard internal format
-                normalized = [normalize_row(r, pos_format) for r in rows]
-                # Filter out empty rows (no item and no revenue)
+            else:
+                body = json.loads(raw) if raw else {}
+
+            csv_text = body.get('csv', '')
+            rows = body.get('rows', [])
+            fixed_costs = float(body.get('fixed_costs', 0))
+            force_format = body.get('pos_format', '')  # optional override
+            expense_csv_text = body.get('expense_csv', '')  # legacy support
+            time_period_months = float(body.get('time_period_months', 1))
+            stocktake_csv_text = body.get('stocktake_csv', '')
+            payroll_csv_text   = body.get('payroll_csv', '')
+            bank_csv_text      = body.get('bank_csv', '')
+
+            # Parse CSV if provided as text
+            pos_format = 'generic'
+            csv_headers = []
+            if csv_text and not rows:
+                rows, pos_format, csv_headers = parse_csv_text(csv_text)
+
+            # Allow client to override detected format
+            if force_format and force_format in POS_COLUMN_MAPS:
+                pos_format = force_format
+
+            if not rows:
+                self._json(400, {'error': 'No data provided. Send "csv" (CSV text) or "rows" (array of objects).'})
+                return
+
+            # Resolve column names once, then normalize all rows to standard internal format
+            headers = csv_headers
+            if not csv_headers:
+                # JSON "rows" (array of objects) → value lists over the union of their keys,
+                # built lazily so only one positional copy of a row exists at a time
+                headers = list(dict.fromkeys(k for r in rows for k in r))
+                rows = (list(map(r.get, headers)) for r in rows)
+            columns = resolve_columns(headers, pos_format)
+            # Lazily normalized: compute_metrics consumes it in the same pass as
+            # aggregation and skips empty rows (no item and no revenue) itself
+            normalized = (normalize_row(r, pos_format, columns) for r in rows)
+
+            # ── Legacy expense file (still supported) ──────────────────────
+            expense_matched = 0
+            expense_general = 0
+            if expense_csv_text:
+                # Cost matching needs every row up front
                 normalized = [r for r in normalized if r['item'] or r['revenue'] > 0]
+                unit_costs, category_costs, general_expenses, expense_rows = parse_expense_data(expense_csv_text)
+                normalized, expense_matched = apply_expense_data(normalized, unit_costs, category_costs)
+                expense_general = general_expenses
+                # Bucket rows by category once instead of rescanning them per expense category
+                rows_by_cat = defaultdict(list)
+                if category_costs:
+                    for r in normalized:
+                        rows_by_cat[_match_key(r['category'])].append(r)
+                for cat_key, cat_cost in category_costs.items():
+                    cat_items = rows_by_cat.get(cat_key)
+                    if cat_items:
+                        total_cat_rev = sum(r['revenue'] for r in cat_items) or 1
+                        for r in cat_items:
+                            if r['cost'] <= 0:
+                                r['cost'] = _r(cat_cost * (r['revenue'] / total_cat_rev))
+                                expense_matched += 1
+                    else:
+                        expense_general += cat_cost
+                fixed_costs += expense_general / time_period_months
+
+            # ── Parse enhanced data sources ────────────────────────────────
+            stocktake = parse_stocktake(stocktake_csv_text) if stocktake_csv_text else None
+            payroll   = parse_payroll(payroll_csv_text) if payroll_csv_text else None
+            bank      = parse_bank_transactions(bank_csv_text) if bank_csv_text else None
+
+            # If bank transactions provided, fold total into fixed costs (monthly)
+            if bank:
+                fixed_costs += bank['total_expenses'] / time_period_months
+
+            # Compute metrics
+            metrics = compute_metrics(normalized, fixed_costs, time_period_months,
+                                      stocktake=stocktake, payroll=payroll, bank=bank,
+                                      truncate=not full)
+            rows_processed = metrics['summary']['rows_processed']
+
+            if not rows_processed:
+                self._json(400, {
+                    'error': f'Could not extract data from your CSV. Detected format: {pos_format}. '
+                             f'Make sure your CSV has columns for item names and sales amounts. '
+                             f'Supported POS systems: Square, Lightspeed, Toast, Clover, Shopify.'
+                })
+                return
+
+            # Get AI recommendations
+            prompt = build_prompt(metrics)
+            ai_text, ai_cache_hit = get_ai_recommendations(prompt)
+
+            result = {
+                'metrics': metrics,
+                'ai_recommendations': ai_text or 'Set GROQ_API_KEY environment variable for free AI recommendations (get key at console.groq.com).',
+                'ai_enabled': bool(GROQ_API_KEY),
+                'analyzed_at': datetime.utcnow().isoformat(),
+                'rows_processed': rows_processed,
+                'pos_format_detected': pos_format,
+                'csv_headers': csv_headers,
+                'time_period_months': time_period_months,
+                'expense_file_used': bool(expense_csv_text),
+                'expense_items_matched': expense_matched,
+                'expense_general_added': _r(expense_general) if expense_csv_text else 0,
+                'stocktake_used': bool(stocktake),
+                'payroll_used': bool(payroll),
+                'bank_used': bool(bank),
+                'stocktake_data': stocktake,
+                'payroll_data': payroll,
+            }
+
+            # X-Cache reports the AI response cache, so only when a lookup happened
+            headers = {'X-Cache': 'HIT' if ai_cache_hit else 'MISS'} if GROQ_API_KEY else None
+            # ?full=1 payloads are unbounded — stream them instead of buffering
+            self._json(200, result, headers=headers, stream=full)
+
+        except Exception as e:
+            self._json(500, {'error': str(e)})
+
+    # Static dispatch tables: normalized path -> handler method
+    GET_ROUTES = {'': _info, '/api': _info, '/api/health': _health}
+    POST_ROUTES = {'/api/analyze': _analyze}
+
+    def _not_modified(self, etag):
+        """Send a bodiless 304 if the client's If-None-Match covers etag."""
+        tags = {t.strip() for t in self.headers.get('If-None-Match', '').split(',')}
+        if etag not in tags and 'W/' + etag not in tags and '*' not in tags:
+            return False
+        self._cors(304)
+        for name, value in _cache_headers(etag).items():
+            self.send_header(name, value)
+        self.end_headers()
+        return True
 
-                if not normalized:
-                    self._json(400, {
-                        'error': f'Could not extract data from your CSV. Detected format: {pos_format}. '
-                                 f'Make sure your CSV has columns for item names and sales amounts. '
-                                 f'Supported POS systems: Square, Lightspeed, Toast, Clover, Shopify.'
-                    })
-                    return
-
-                # ── Legacy expense file (still supported) ──────────────────────
-                expense_matched = 0
-                expense_general = 0
-                if expense_csv_text:
-                    unit_costs, category_costs, general_expenses, expense_rows = parse_expense_data(expense_csv_text)
-                    normalized, expense_matched = apply_expense_data(normalized, unit_costs, category_costs)
-                    expense_general = general_expenses
-                    for cat_key, cat_cost in category_costs.items():
-                        cat_items = [r for r in normalized if r['category'].lower().strip() == cat_key]
-                        if cat_items:
-                            total_cat_rev = sum(r['revenue'] for r in cat_items) or 1
-                            for r in cat_items:
-                                if r['cost'] <= 0:
-                                    r['cost'] = _r(cat_cost * (r['revenue'] / total_cat_rev))
-                                    expense_matched += 1
-                        else:
-                            expense_general += cat_cost
-                    fixed_costs += expense_general / time_period_months
-
-                # ── Parse enhanced data sources ────────────────────────────────
-                stocktake = parse_stocktake(stocktake_csv_text) if stocktake_csv_text else None
-                payroll   = parse_payroll(payroll_csv_text) if payroll_csv_text else None
-                bank      = parse_bank_transactions(bank_csv_text) if bank_csv_text else None
-
-                # If bank transactions provided, fold total into fixed costs (monthly)
-                if bank:
-                    fixed_costs += bank['total_expenses'] / time_period_months
-
-                # Compute metrics
-                metrics = compute_metrics(normalized, fixed_costs, time_period_months,
-                                          stocktake=stocktake, payroll=payroll, bank=bank)
-
-                # Get AI recommendations
-                prompt = build_prompt(metrics)
-                ai_text = call_groq(prompt)
-
-                result = {
-                    'metrics': metrics,
-                    'ai_recommendations': ai_text or 'Set GROQ_API_KEY environment variable for free AI recommendations (get key at console.groq.com).',
-                    'ai_enabled': bool(GROQ_API_KEY),
-                    'analyzed_at': datetime.utcnow().isoformat(),
-                    'rows_processed': len(normalized),
-                    'pos_format_detected': pos_format,
-                    'csv_headers': csv_headers,
-                    'time_period_months': time_period_months,
-                    'expense_file_used': bool(expense_csv_text),
-                    'expense_items_matched': expense_matched,
-                    'expense_general_added': _r(expense_general) if expense_csv_text else 0,
-                    'stocktake_used': bool(stocktake),
-                    'payroll_used': bool(payroll),
-                    'bank_used': bool(bank),
-                    'stocktake_data': stocktake,
-                    'payroll_data': payroll,
-                }
-
-                self._json(200, result)
-
-            except Exception as e:
-                self._json(500, {'error': str(e)})
-        else:
-            self._json(404, {'error': 'Not found. Use POST /api/analyze'})
+    def _json(self, code, data, headers=None, stream=False):
+        if not stream:
+            # One-shot encode uses the C encoder — fastest for bounded payloads
+            self._send_bytes(code, _JSON_ENCODER.encode(data).encode(), headers)
+            return
+        self._cors(code)
+        self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self._write_stream(_JSON_ENCODER.iterencode(data))
 
-    def _json(self, code, data):
+    def _send_bytes(self, code, payload, headers=None):
+        """Send an already-encoded JSON body with its Content-Length."""
         self._cors(code)
         self.send_header('Content-Type', 'application/json')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
         self.end_headers()
-        self.wfile.write(json.dumps(data).encode())
+        self.wfile.write(payload)
+
+    def _write_stream(self, chunks):
+        """Write encoder output in ~JSON_WRITE_BUFFER batches so the whole
+        body is never held in memory as both str and bytes."""
+        buf = []
+        size = 0
+        for chunk in chunks:
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= JSON_WRITE_BUFFER:
+                self.wfile.write(''.join(buf).encode())
+                buf = []
+                size = 0
+        if buf:
+            self.wfile.write(''.join(buf).encode())
 
     def _cors(self, code):
         self.send_response(code)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
         self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Expose-Headers', 'X-Cache, ETag')
 
     def log_message(self, *args):
         pass  # Silence logs in serverless
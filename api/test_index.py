@@ -0,0 +1,246 @@
+"""
+Regression tests for the /api endpoints, run against a local server.
+Run with: python -m unittest discover -s api
+"""
+
+import http.client
+import json
+import os
+import threading
+import unittest
+from http.server import HTTPServer
+
+os.environ.pop('GROQ_API_KEY', None)  # keep AI off so results are deterministic
+
+import index  # noqa: E402
+
+SAMPLE_DIR = os.path.join(os.path.dirname(__file__), '..', 'sample_data')
+
+
+def _sample(name):
+    with open(os.path.join(SAMPLE_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+class ApiTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), index.handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def request(self, method, path, body=None, headers=None):
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=10)
+        try:
+            conn.request(method, path, body=body, headers=headers or {})
+            resp = conn.getresponse()
+            return resp.status, resp.headers, resp.read()
+        finally:
+            conn.close()
+
+    def analyze(self, payload, path='/api/analyze'):
+        status, headers, raw = self.request(
+            'POST', path, json.dumps(payload), {'Content-Type': 'application/json'})
+        return status, headers, json.loads(raw)
+
+
+class AnalyzeTests(ApiTestCase):
+    def test_sample_files(self):
+        status, headers, data = self.analyze({
+            'csv': _sample('cafe_sales.csv'),
+            'fixed_costs': 3500,
+            'stocktake_csv': _sample('sample_stocktake.csv'),
+            'payroll_csv': _sample('sample_payroll.csv'),
+            'bank_csv': _sample('sample_bank_transactions.csv'),
+        })
+        self.assertEqual(status, 200)
+        self.assertEqual(data['pos_format_detected'], 'generic')
+        self.assertEqual(data['rows_processed'], 50)
+        s = data['metrics']['summary']
+        self.assertEqual(s['total_revenue'], 10166.0)
+        self.assertEqual(s['total_cogs'], 2829.4)
+        self.assertEqual(s['gross_profit'], 7336.6)
+        self.assertEqual(s['net_profit'], -9355.4)
+        self.assertEqual(s['num_days'], 5)
+        self.assertEqual(s['true_cogs'], 4211.0)
+        self.assertEqual(s['labour_cost'], 31224.0)
+        self.assertEqual(s['bank_expenses'], 13192.0)
+        self.assertEqual(data['metrics']['top_items'][0]['name'], 'Avocado Toast')
+        self.assertFalse(data['metrics']['truncated'])
+        self.assertIsNone(data['metrics']['categories_other'])
+        self.assertIsNone(headers['X-Cache'])  # AI is off: no cache lookup happened
+
+    def test_json_rows(self):
+        status, _, data = self.analyze({'rows': [
+            {'Item': 'Latte', 'Price': '4.50', 'Quantity': '2', 'Date': '1/15/2026 8:05 AM'},
+            {'Item': 'Tea', 'Price': '3'},
+        ]})
+        self.assertEqual(status, 200)
+        self.assertEqual(data['metrics']['summary']['total_revenue'], 12.0)
+        self.assertEqual(list(data['metrics']['daily']), ['2026-01-15'])
+
+    def test_text_csv_body_matches_json(self):
+        csv_text = _sample('cafe_sales.csv')
+        _, _, expected = self.analyze({'csv': csv_text, 'fixed_costs': 3500, 'time_period_months': 2})
+        status, _, raw = self.request(
+            'POST', '/api/analyze?fixed_costs=3500&time_period_months=2&rows=x&bank_csv=a,b',
+            csv_text.encode(), {'Content-Type': 'text/csv'})
+        self.assertEqual(status, 200)
+        data = json.loads(raw)
+        for d in (expected, data):
+            d.pop('analyzed_at')
+        self.assertEqual(data, expected)  # undocumented query keys are ignored
+
+    def test_semicolon_delimited_csv(self):
+        status, headers, raw = self.request(
+            'POST', '/api/analyze', 'date;item;price;quantity\n2026-01-01;Latte;4;2\n',
+            {'Content-Type': 'text/csv'})
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Content-Length'], str(len(raw)))
+        self.assertEqual(json.loads(raw)['metrics']['summary']['total_revenue'], 8.0)
+
+    def test_semicolon_decimal_comma_csv(self):
+        # European Square export: ';' delimiter, "4,50" decimals, "1.234,56" thousands
+        _, _, data = self.analyze({'csv': (
+            'Date;Item;Category;Gross Sales;Net Sales;Qty\n'
+            '15.01.2026;Latte;Coffee;4,50;4,50;1\n'
+            '15.01.2026;Catering;Food;"1.234,56";"1.234,56";1\n'
+            '16.01.2026;Scone;Food;€3,00;€3,00;2\n'
+        )})
+        self.assertEqual(data['pos_format_detected'], 'square')
+        m = data['metrics']
+        self.assertEqual(m['categories']['Coffee']['revenue'], 4.5)
+        self.assertEqual(m['categories']['Food']['revenue'], 1237.56)
+        self.assertEqual(m['summary']['total_revenue'], 1242.06)
+
+    def test_semicolon_dot_decimal_csv(self):
+        # No "4,50"-style numbers: dots stay decimal points
+        _, _, data = self.analyze({'csv': 'date;item;price;quantity\n2026-01-01;Latte;4.50;2\n'})
+        self.assertEqual(data['metrics']['summary']['total_revenue'], 9.0)
+
+    EXPENSE_SALES = ('item,category,price,quantity\n'
+                     'Flat White,Coffee,5,10\n'
+                     'Iced Latte,Coffee,6,5\n'
+                     'Croissant,Pastry,4,10\n'
+                     'Muffin,Pastry,4,30\n')
+    EXPENSES = ('description,department,cost,quantity\n'
+                'Flat White,,12,10\n'   # item-level: unit cost 1.20
+                'Latte,,2,1\n'          # partial name match: "latte" in "iced latte"
+                ',Pastry,80,\n'         # category-level: spread by revenue
+                ',Merch,25,\n'          # category with no sales rows: general expense
+                ',,15,\n')              # no item or category: general expense
+
+    def expense_costs(self):
+        _, _, data = self.analyze({'csv': self.EXPENSE_SALES, 'expense_csv': self.EXPENSES})
+        return data, {i['name']: i['cost'] for i in data['metrics']['top_items']}
+
+    def test_expense_item_unit_cost(self):
+        data, costs = self.expense_costs()
+        self.assertTrue(data['expense_file_used'])
+        self.assertEqual(costs['Flat White'], 12.0)
+
+    def test_expense_partial_name_match(self):
+        _, costs = self.expense_costs()
+        self.assertEqual(costs['Iced Latte'], 10.0)  # 5 units x 2.00
+
+    def test_expense_category_spread(self):
+        data, costs = self.expense_costs()
+        # 80 split by revenue share: Croissant 40 of 160, Muffin 120 of 160
+        self.assertEqual(costs['Croissant'], 20.0)
+        self.assertEqual(costs['Muffin'], 60.0)
+        self.assertEqual(data['expense_items_matched'], 4)
+        self.assertEqual(data['metrics']['summary']['total_cogs'], 102.0)
+
+    def test_expense_unmatched_category_is_general(self):
+        data, _ = self.expense_costs()
+        self.assertEqual(data['expense_general_added'], 40.0)  # Merch 25 + uncategorised 15
+        self.assertEqual(data['metrics']['summary']['fixed_costs'], 40.0)
+
+    def test_truncation(self):
+        lines = ['date,item,category,price,quantity']
+        for i in range(100):
+            lines.append(f'2026-{1 + i // 28:02d}-{1 + i % 28:02d},Item {i},Cat {i % 25},{i + 1},1')
+        payload = {'csv': '\n'.join(lines)}
+
+        _, _, data = self.analyze(payload)
+        m = data['metrics']
+        self.assertTrue(m['truncated'])
+        self.assertEqual(len(m['categories']), index.MAX_CATEGORIES)
+        self.assertEqual(len(m['daily']), index.MAX_DAILY_DAYS)
+        self.assertEqual(m['categories_other']['count'], 5)
+        shown = sum(c['revenue'] for c in m['categories'].values())
+        self.assertEqual(shown + m['categories_other']['revenue'], m['summary']['total_revenue'])
+
+        _, _, full = self.analyze(payload, '/api/analyze?full=1')
+        self.assertFalse(full['metrics']['truncated'])
+        self.assertEqual(len(full['metrics']['categories']), 25)
+        self.assertEqual(len(full['metrics']['daily']), 100)
+        self.assertEqual(full['metrics']['summary'], m['summary'])
+
+    def test_no_data(self):
+        status, _, data = self.analyze({'csv': ''})
+        self.assertEqual(status, 400)
+        status, _, data = self.analyze({'csv': 'a,b\n1,2\n'})
+        self.assertEqual(status, 400)
+
+
+class RequestGuardTests(ApiTestCase):
+    def raw_post(self, content_length, content_type='application/json'):
+        conn = http.client.HTTPConnection('127.0.0.1', self.server.server_port, timeout=10)
+        try:
+            conn.putrequest('POST', '/api/analyze')
+            conn.putheader('Content-Type', content_type)
+            conn.putheader('Content-Length', content_length)
+            conn.endheaders()
+            return conn.getresponse().status
+        finally:
+            conn.close()
+
+    def test_invalid_content_length(self):
+        self.assertEqual(self.raw_post('abc'), 400)
+        self.assertEqual(self.raw_post('-5'), 400)
+
+    def test_payload_too_large(self):
+        self.assertEqual(self.raw_post(str(index.MAX_BODY_BYTES + 1)), 413)
+
+    def test_unsupported_content_type(self):
+        status, _, _ = self.request('POST', '/api/analyze', 'x', {'Content-Type': 'text/plain'})
+        self.assertEqual(status, 415)
+
+    def test_non_utf8_csv(self):
+        status, _, _ = self.request('POST', '/api/analyze', b'\xff\xfeitem', {'Content-Type': 'text/csv'})
+        self.assertEqual(status, 400)
+
+    def test_unknown_route(self):
+        self.assertEqual(self.request('POST', '/api/nope')[0], 404)
+        self.assertEqual(self.request('GET', '/api/nope')[0], 404)
+
+
+class MetadataTests(ApiTestCase):
+    def test_etag_revalidation(self):
+        for path in ('/api', '/api/', '/api/health'):
+            status, headers, raw = self.request('GET', path)
+            self.assertEqual(status, 200)
+            self.assertEqual(headers['Content-Length'], str(len(raw)))
+            etag = headers['ETag']
+            self.assertTrue(etag)
+
+            status, headers, raw = self.request('GET', path, headers={'If-None-Match': etag})
+            self.assertEqual(status, 304)
+            self.assertEqual(raw, b'')
+            self.assertEqual(headers['ETag'], etag)
+
+            status, _, _ = self.request('GET', path, headers={'If-None-Match': '"stale"'})
+            self.assertEqual(status, 200)
+
+    def test_health(self):
+        _, _, raw = self.request('GET', '/api/health')
+        self.assertEqual(json.loads(raw), {'status': 'healthy', 'ai': False})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -700,6 +700,19 @@ Ava Taylor,Barista,January 2026,140,24.00,3360.00`;
                           </tr>
                         );
                       })}
+                      {results.metrics.categories_other && (() => {
+                        const d = results.metrics.categories_other;
+                        const margin = d.revenue > 0 ? ((d.profit / d.revenue) * 100).toFixed(1) : '0.0';
+                        return (
+                          <tr className="border-b border-dark-600/20 last:border-0">
+                            <td className="px-5 py-2.5 font-medium text-gray-500 italic">Other ({d.count} more)</td>
+                            <td className="px-5 py-2.5 text-right text-xero-dark">${d.revenue.toLocaleString()}</td>
+                            <td className="px-5 py-2.5 text-right text-gray-500">${d.cost.toLocaleString()}</td>
+                            <td className={`px-5 py-2.5 text-right font-semibold ${d.profit >= 0 ? 'text-gain' : 'text-loss'}`}>${d.profit.toLocaleString()}</td>
+                            <td className="px-5 py-2.5 text-right text-xero-dark">{margin}%</td>
+                          </tr>
+                        );
+                      })()}
                     </tbody>
                     <tfoot>
                       <tr className="border-t-2 border-dark-600/40 bg-dark-700/30">
@@ -1047,7 +1060,7 @@ function KPIDashboard({ results }) {
             <div className="h-1 bg-xero-teal"></div>
             <div className="px-5 pt-4 pb-3">
               <h3 className="text-sm font-semibold text-xero-dark uppercase tracking-wide">Daily Revenue</h3>
-              <p className="text-[11px] text-gray-400 mt-0.5">Avg ${s.avg_daily_revenue} / day over {dailyData.length} days</p>
+              <p className="text-[11px] text-gray-400 mt-0.5">Avg ${s.avg_daily_revenue} / day over {s.num_days} days</p>
             </div>
             <div className="px-4 pb-4">
               <div className="flex items-end gap-px" style={{ height: '112px' }}>